@@ -1,26 +1,53 @@
 import functools
+import hashlib
+import io
+import json
 import os
 import re
+import subprocess
+import sys
+import tempfile
+import threading
 
 import click
-import delegator
 
-from jsonschema import validate
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from poetry.utils.toml_file import TomlFile
-from poetry.packages import Package, VCSDependency
+from poetry.packages import Dependency, Package, VCSDependency
+from poetry.utils.helpers import canonicalize_name
+from tomlkit import loads
 
 VERSION_BUMP_RE = re.compile(
     r"(?P<major>\*)|(?P<minor>\d+\.\*)|(?P<patch>\d+\.\d+\.\*)"
 )
-VERSION_RE = re.compile('version\s+=\s+"*(?P<version>(\d+\.\d+\.\d+))"*')
+VERSION_RE = re.compile(r"\d+\.\d+\.\d+")
+# python files at least two directories deep, we don't detect changes
+# in non python code nor in top level files like ai/__init__.py
+CHANGED_PY_RE = re.compile(r"(?P<dir>[^/]+/.+)/[^/]+\.py")
 
 ROOT_PATH = Path(".")
+# directories which never contain packages, not worth walking into
+PRUNED_DIRS = {
+    ".git",
+    ".tox",
+    ".nox",
+    ".venv",
+    "venv",
+    "__pycache__",
+    ".pytest_cache",
+    "node_modules",
+}
 REPO_NAME = re.compile(r"europe(\.\w+])*")
 
 AUTOGEN_SETUP_PY = "setup.py"
+DIST_DIR = ROOT_PATH / "dist"
 AUTOGEN_REQ_INI = "requirements.ini"
 AUTOGEN_REQ_TXT = "requirements.txt"
+PAC_CACHE_FILE = ROOT_PATH / ".pac-cache.json"
+# bump when create_light changes what it extracts from pac.toml files
+PAC_CACHE_VERSION = 2
 AUTO_TEST = "autogen_test.sh"
 
 PAC_JSON_SCHEMA = {
@@ -77,28 +104,26 @@ setup(
 """
 
 
-def cleanup(func):
-    @functools.wraps(func)
-    def wraps(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            raise RuntimeError(e)
-        finally:
-            for file in [AUTOGEN_REQ_INI, AUTOGEN_REQ_TXT, AUTOGEN_SETUP_PY]:
-                if os.path.isfile(file):
-                    os.remove(file)
-
-    return wraps
+def _run(*args, cwd=None):
+    # poetry swaps subprocess.run for a backport without capture_output/text
+    return subprocess.run(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=cwd,
+    )
 
 
 class ModifiedPackage(Package):
     def __init__(self, name, version, old_version):
-        if not VERSION_BUMP_RE.match(version):
+        match = VERSION_BUMP_RE.match(version)
+        if not match:
             raise RuntimeError(NO_MANUL_BUMP_VERSION_ERROR.format(name=name))
 
         self._old_version = old_version
-        self._next_version = _get_next_version(version, old_version)
+        # the matched group names the part to bump
+        self._next_version = _get_next_version(match.lastgroup, old_version)
         super().__init__(name, self._next_version)
 
     @property
@@ -110,33 +135,207 @@ class ModifiedPackage(Package):
         return self._old_version
 
 
-def _get_next_version(version_constraint, old_version) -> str:
-    match = VERSION_BUMP_RE.match(version_constraint)
-    major, minor, patch = old_version.split(".")
+_BUMPERS = {
+    "major": lambda major, minor, patch: f"{major+1}.0.0",
+    "minor": lambda major, minor, patch: f"{major}.{minor+1}.0",
+    "patch": lambda major, minor, patch: f"{major}.{minor}.{patch+1}",
+}
+
+
+def _get_next_version(kind, old_version) -> str:
+    # kind is the VERSION_BUMP_RE group that matched the constraint
+    return _BUMPERS[kind](*map(int, old_version.split(".")))
+
+
+class GitBatch:
+    """
+    Reads blobs through a single long running `git cat-file --batch` process,
+    instead of spawning one git subprocess per lookup
+    """
+
+    def __init__(self):
+        self._process = None
+        # requests and responses share one pipe, one lookup at a time
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process.wait()
+        self._process = None
 
-    if match.group("major"):
-        return f"{int(major)+1}.0.0"
+    def blob(self, ref) -> bytes:
+        with self._lock:
+            self._process.stdin.write(f"{ref}\n".encode())
+            self._process.stdin.flush()
 
-    elif match.group("minor"):
-        return f"{major}.{int(minor)+1}.0"
+            # <sha> blob <size>, or <ref> missing
+            header = self._process.stdout.readline().split()
+            if len(header) != 3 or header[1] != b"blob":
+                raise RuntimeError(f"Can't find blob {ref} in git")
 
-    elif match.group("patch"):
-        return f"{major}.{minor}.{int(patch)+1}"
+            size = int(header[2])
+            # the content is always followed by a newline
+            return self._process.stdout.read(size + 1)[:size]
 
 
-def _get_old_version(pac_file) -> str:
-    c = delegator.run(f"git show origin/master:{pac_file} | grep version")
-    match = VERSION_RE.match(c.out)
-    if not match:
+def _get_old_version(pac_file, batch) -> str:
+    blob = batch.blob(f"origin/master:{pac_file}")
+    version = str(loads(blob.decode()).get("package", {}).get("version", ""))
+    if not VERSION_RE.fullmatch(version):
         raise RuntimeError(
             f"Modified package {pac_file} doesn't have a correct semantic version"
         )
-    return match.group("version")
+    return version
+
+
+@functools.lru_cache(maxsize=None)
+def _pac_validator():
+    # jsonschema is slow to import, only load it once something
+    # actually needs to be validated
+    from jsonschema import Draft7Validator
+
+    Draft7Validator.check_schema(PAC_JSON_SCHEMA)
+    return Draft7Validator(PAC_JSON_SCHEMA)
+
+
+def _package_name(pac_file: Path) -> str:
+    # europe/france/pac.toml -> europe.france
+    return ".".join(pac_file.parent.parts)
+
+
+# pac.toml files already validated, by (path, mtime, size)
+_VALIDATED = set()
+
+
+def _pac_key(pac_file: Path):
+    stat = pac_file.stat()
+    return pac_file.as_posix(), stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=None)
+def _read_pac(pac_file: str, mtime_ns: int, size: int):
+    return loads(Path(pac_file).read_text())
+
+
+def load_pac(pac_file: Path):
+    """
+    Parses a pac.toml file, only once as long as it stays unmodified.
+    The document is shared between callers, don't modify it
+    """
+    return _read_pac(*_pac_key(pac_file))
+
+
+def find_pac_files(root=ROOT_PATH):
+    """
+    Walks the repo for pac.toml files, reusing the file types from
+    scandir and skipping PRUNED_DIRS
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in PRUNED_DIRS:
+                        stack.append(entry.path)
+                elif entry.name == "pac.toml":
+                    yield Path(entry.path)
+
+
+class LightCache:
+    """
+    Keeps what create_light reads from each pac.toml between runs, so
+    unmodified files are neither parsed nor validated again
+    """
+
+    def __init__(self, file: Path):
+        self._file = file
+        self._modified = False
+        # paths looked up in this run, the others are gone from the repo
+        self._seen = set()
+        # entries are validated against the schema and extracted by
+        # create_light, they don't hold anymore once either changes
+        self._tag = {
+            "version": PAC_CACHE_VERSION,
+            "schema": hashlib.sha1(
+                json.dumps(PAC_JSON_SCHEMA, sort_keys=True).encode()
+            ).hexdigest(),
+        }
+        try:
+            data = json.loads(file.read_text())
+        except (OSError, ValueError):
+            data = {}
+        if isinstance(data, dict) and data.get("tag") == self._tag:
+            self._entries = data["entries"]
+        else:
+            self._entries = {}
+            self._modified = True
+
+    def get(self, key):
+        path, mtime_ns, size = key
+        self._seen.add(path)
+        entry = self._entries.get(path)
+        if entry is None or entry["stat"] != [mtime_ns, size]:
+            return None
+        return entry
+
+    def set(self, key, entry):
+        path, mtime_ns, size = key
+        self._seen.add(path)
+        self._entries[path] = dict(entry, stat=[mtime_ns, size])
+        self._modified = True
+
+    def save(self):
+        if not self._seen.issuperset(self._entries):
+            self._entries = {
+                path: entry
+                for path, entry in self._entries.items()
+                if path in self._seen
+            }
+            self._modified = True
+
+        if self._modified:
+            self._file.write_text(
+                json.dumps({"tag": self._tag, "entries": self._entries})
+            )
+            self._modified = False
+
+
+def _add_dependency(package, name, constraint, category="main"):
+    # most constraints are plain version strings, which don't need
+    # the vcs/file/marker handling of Package.add_dependency
+    if not isinstance(constraint, str):
+        return package.add_dependency(name, constraint, category=category)
+
+    dependency = Dependency(name, constraint, category=category)
+    if category == "dev":
+        package.dev_requires.append(dependency)
+    else:
+        package.requires.append(dependency)
+    return dependency
+
+
+def _iter_constraints(constraint):
+    # a dependency may list several constraints, e.g. one per python version
+    return constraint if isinstance(constraint, list) else (constraint,)
+
+
+LightPackage = namedtuple("LightPackage", "name version requires pac_file")
 
 
 class Pac:
+    __slots__ = ("_file", "_local_config", "_package")
+
     def __init__(self, file: Path, local_config: dict, package: Package):
-        self._file = TomlFile(file)
+        self._file = file
         self._local_config = local_config
         self._package = package
 
@@ -153,76 +352,157 @@ class Pac:
         return self._package
 
     @classmethod
-    def create(cls, pac_file: Path, modified=False):
-
-        local_config = TomlFile(pac_file.as_posix()).read()
+    def read(cls, pac_file: Path):
+        key = _pac_key(pac_file)
+        local_config = _read_pac(*key)
         if "package" not in local_config:
             raise RuntimeError(
                 "[package] section not found in {}".format(pac_file.name)
             )
-        # Checking validity
-        cls.check(local_config)
+        # Checking validity, unless the same file content passed already
+        if key not in _VALIDATED:
+            cls.check(local_config)
+            _VALIDATED.add(key)
 
-        name = str(pac_file.parent).replace("/", ".")
+        return local_config
+
+    @classmethod
+    def create(cls, pac_file: Path, modified=False, batch=None):
+
+        local_config = cls.read(pac_file)
+
+        name = _package_name(pac_file)
         version = local_config["package"]["version"]
 
         if not modified:
             package = Package(name, version)
         else:
-            old_version = _get_old_version(pac_file)
+            old_version = _get_old_version(pac_file, batch)
             package = ModifiedPackage(name, version, old_version)
 
         package.root_dir = pac_file.parent
 
-        if "dependencies" in local_config:
-            for name, constraint in local_config["dependencies"].items():
-                package.add_dependency(name, constraint)
+        for name, constraint in local_config.get("dependencies", {}).items():
+            for c in _iter_constraints(constraint):
+                _add_dependency(package, name, c)
 
-        if "dev-dependencies" in local_config:
-            for name, constraint in local_config["dev-dependencies"].items():
-                package.add_dependency(name, constraint, category="dev")
+        for name, constraint in local_config.get("dev-dependencies", {}).items():
+            for c in _iter_constraints(constraint):
+                _add_dependency(package, name, c, category="dev")
 
         return cls(pac_file, local_config, package)
 
+    @classmethod
+    def create_light(cls, pac_file: Path, cache=None):
+        """
+        Reads only what is needed to check whether a package depends on
+        other packages of this repo: no dev dependencies and no vcs, file
+        or path dependencies, which can't refer to a released package
+        """
+        key = _pac_key(pac_file)
+        entry = cache.get(key) if cache is not None else None
+
+        if entry is None:
+            local_config = cls.read(pac_file)
+
+            requires = {}
+            for name, constraint in local_config.get("dependencies", {}).items():
+                versions = []
+                for c in _iter_constraints(constraint):
+                    if isinstance(c, dict):
+                        c = c.get("version")
+                        if c is None:
+                            continue
+                    versions.append(str(c))
+                # several constraints accept the union of their versions
+                if versions:
+                    requires[name] = " || ".join(versions)
+
+            entry = {
+                "version": str(local_config["package"]["version"]),
+                "requires": requires,
+            }
+            if cache is not None:
+                cache.set(key, entry)
+
+        return LightPackage(
+            # the same name as Package and Dependency, which reverse
+            # dependency lookups are keyed by
+            name=canonicalize_name(_package_name(pac_file)),
+            version=entry["version"],
+            requires=tuple(
+                Dependency(name, constraint)
+                for name, constraint in entry["requires"].items()
+            ),
+            pac_file=pac_file,
+        )
+
     @classmethod
     def check(cls, config):
         """
         Checks the validity of a configuration
         """
-        validate(config, PAC_JSON_SCHEMA)
-
+        _pac_validator().validate(config)
 
-def track_changed_paths():
-    c = delegator.run("git diff origin/master --name-only")
-    package_paths = set()
 
-    for path in c.out.split("\n"):
-        # we don't detect changes in non python code
-        if Path(path).suffix != ".py":
+def _iter_changed_files():
+    """
+    Streams the files changed against origin/master from git's output,
+    without buffering the whole diff
+    """
+    with subprocess.Popen(
+        ["git", "diff", "origin/master", "--name-only", "-z"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as process:
+        rest = b""
+        for chunk in iter(lambda: process.stdout.read(65536), b""):
+            *paths, rest = (rest + chunk).split(b"\0")
+            for path in paths:
+                yield os.fsdecode(path)
+        stderr = process.stderr.read()
+
+    if process.returncode:
+        raise RuntimeError(stderr.decode())
+
+
+def track_changed_paths(pac_dirs):
+    """
+    Finds the pac.toml files of packages with changed python files,
+    pac_dirs holds the posix path of every package directory
+    """
+    package_dirs = set()
+    # top level directories holding packages, e.g. "europe/"
+    prefixes = tuple({pac_dir.partition("/")[0] + "/" for pac_dir in pac_dirs})
+
+    # plain string operations, git always prints paths with "/"
+    for path in _iter_changed_files():
+        # cheap checks first, most of a large diff never reaches the regex
+        if not path.endswith(".py") or not path.startswith(prefixes):
             continue
-
-        # ai/__init__.py
-        if len(Path(path).parts) <= 2:
+        match = CHANGED_PY_RE.fullmatch(path)
+        if not match:
             continue
 
-        package_path = Path(path).parent
-        if "tests" in str(package_path):
-            package_path = Path(path).parents[1]
-
-        while True:
-            # make sure changes belong to one of the package
-            if (package_path / "pac.toml").exists():
+        # make sure changes belong to one of the package
+        package_dir = match.group("dir")
+        while package_dir:
+            if package_dir in pac_dirs:
+                package_dirs.add(package_dir)
                 break
-            package_path = Path(package_path).parents[0]
-        package_paths.add(package_path)
+            package_dir = package_dir.rpartition("/")[0]
 
-    return set(path / "pac.toml" for path in package_paths)
+    return {Path(package_dir) / "pac.toml" for package_dir in package_dirs}
 
 
 class PackageManager:
-    def __init__(self, package, is_dev=False):
+    def __init__(self, package, workdir: Path, is_dev=False, out=None):
         self._package = package
         self._is_dev = is_dev
+        self._workdir = workdir
+        # where command outputs are printed, stdout by default
+        self._out = out
+        self._setup_py = workdir / AUTOGEN_SETUP_PY
         self._requirements = self.get_requirements()
 
     @property
@@ -236,7 +516,21 @@ class PackageManager:
             requirements = self._package.requires
         return requirements
 
+    def stage(self):
+        """
+        Links the package sources into the workdir, next to the generated
+        setup.py, which is run from there
+        """
+        package_dir = self._workdir.joinpath(*self._package.name.split("."))
+        if not package_dir.exists():
+            package_dir.parent.mkdir(parents=True, exist_ok=True)
+            package_dir.symlink_to(
+                self._package.root_dir.resolve(), target_is_directory=True
+            )
+
     def generate_setup(self):
+        self.stage()
+
         dependency_links, package_requires = [], []
         for dep in self._requirements:
             if isinstance(dep, VCSDependency):
@@ -246,192 +540,290 @@ class PackageManager:
                 constraint = constraint.replace("(", "").replace(")", "")
                 package_requires.append(f"{name}{constraint}")
 
-        with open(AUTOGEN_SETUP_PY, "w+") as f:
-            f.write(
-                SETUP_PY_TEMPLATE.format(
-                    package_name=self._package.name,
-                    package_version=self._package.version,
-                    dependency_links=dependency_links,
-                    install_requires=package_requires,
-                )
+        self._setup_py.write_text(
+            SETUP_PY_TEMPLATE.format(
+                package_name=self._package.name,
+                package_version=self._package.version,
+                dependency_links=dependency_links,
+                install_requires=package_requires,
             )
-
-        assert os.path.isfile(AUTOGEN_SETUP_PY)
+        )
 
     @classmethod
-    def generate_requirements_text(cls, requirements):
-        with open(AUTOGEN_REQ_INI, "w+") as f:
-            for dep in requirements:
-                if isinstance(dep, VCSDependency):
-                    f.write(f"-e {dep.source}#egg={dep.name}\n")
-                else:
-                    f.write(f"{dep.to_pep_508()}\n")
+    def generate_requirements_text(cls, requirements, workdir: Path):
+        lines = []
+        for dep in requirements:
+            if isinstance(dep, VCSDependency):
+                lines.append(f"-e {dep.source}#egg={dep.name}\n")
+            else:
+                lines.append(f"{dep.to_pep_508()}\n")
+
+        # packages often share requirements, list each of them once
+        req_ini = workdir / AUTOGEN_REQ_INI
+        req_ini.write_text("".join(sorted(set(lines))))
         # lookup for local package
-        c = delegator.run(f"pip-compile {AUTOGEN_REQ_INI} -v -f ./dist")
-        c.run()
-        if c.err:
-            raise RuntimeError(c.err)
-        print(c.out)
+        c = _run("pip-compile", str(req_ini), "-v", "-f", "./dist")
+        if c.stderr:
+            raise RuntimeError(c.stderr)
+        print(c.stdout)
 
-        assert os.path.isfile(AUTOGEN_REQ_TXT)
+        assert os.path.isfile(workdir / AUTOGEN_REQ_TXT)
 
-    def install(self):
+    @classmethod
+    def install_requirements(cls, workdir: Path, is_dev=False):
+        req_txt = str(workdir / AUTOGEN_REQ_TXT)
+        if is_dev:
+            install_requires = ["pip", "install", "--no-cache-dir", "-r", req_txt]
+        else:
+            install_requires = ["pip", "install", "-r", req_txt, "-f", "./dist"]
+        c = _run(*install_requires)
+        if not ("warning" in c.stderr or c.stderr == ""):
+            raise RuntimeError(c.stderr)
+
+        print(c.stdout)
+
+    def install(self, with_requirements=True):
+        """
+        Installs the package, and its requirements unless they are
+        already compiled and installed by the caller
+        """
         self.generate_setup()
-        self.generate_requirements_text(self.requirements)
+        if with_requirements:
+            self.generate_requirements_text(self.requirements, self._workdir)
 
-        c1 = delegator.run(f"python {AUTOGEN_SETUP_PY} install")
-        if self._is_dev:
-            install_requires = f"pip install --no-cache-dir -r {AUTOGEN_REQ_TXT}"
-        else:
-            install_requires = f"pip install -r {AUTOGEN_REQ_TXT} -f ./dist"
-        c2 = delegator.run(install_requires)
-        for c in [c1, c2]:
-            if "warning" in c.err or c.err == "":
-                continue
-            raise RuntimeError(c.err)
+        c = _run("python", AUTOGEN_SETUP_PY, "install", cwd=self._workdir)
+        if not ("warning" in c.stderr or c.stderr == ""):
+            raise RuntimeError(c.stderr)
 
-        print(c1.out)
-        print(c2.out)
+        print(c.stdout, file=self._out)
+
+        if with_requirements:
+            self.install_requirements(self._workdir, self._is_dev)
 
     def test(self):
         path = self._package.name.replace(".", "/")
-        c = delegator.run(f"pytest {path}")
-        if c.err:
-            raise RuntimeError(c.err)
-        print(c.out)
+        c = _run("pytest", path)
+        if c.stderr:
+            raise RuntimeError(c.stderr)
+        print(c.stdout, file=self._out)
 
     def distribute(self):
         self.generate_setup()
 
-        c = delegator.run(f"python {AUTOGEN_SETUP_PY} sdist")
-        if c.err:
-            if "warning" in c.err or c.err == "":
-                print(c.out)
+        c = _run(
+            "python",
+            AUTOGEN_SETUP_PY,
+            "sdist",
+            "--dist-dir",
+            str(DIST_DIR.resolve()),
+            cwd=self._workdir,
+        )
+        if c.stderr:
+            if "warning" in c.stderr or c.stderr == "":
+                print(c.stdout, file=self._out)
             else:
-                raise RuntimeError(c.err)
-        print(c.out)
+                raise RuntimeError(c.stderr)
+        print(c.stdout, file=self._out)
 
         if self._is_dev:
             return
 
         url = os.environ["PYPI_URL"]
-        c = delegator.run(
-            f"twine upload -u {os.environ['TWINE_USERNAME']} -p "
-            f"{os.environ['TWINE_PASSWORD']} --repository-url {url} "
-            f"dist/{self._package.name}-{self._package.version}.tar.gz"
+        c = _run(
+            "twine",
+            "upload",
+            "-u",
+            os.environ["TWINE_USERNAME"],
+            "-p",
+            os.environ["TWINE_PASSWORD"],
+            "--repository-url",
+            url,
+            str(DIST_DIR / f"{self._package.name}-{self._package.version}.tar.gz"),
         )
-        if c.err:
-            raise RuntimeError(c.err)
-        print(c.out)
+        if c.stderr:
+            raise RuntimeError(c.stderr)
+        print(c.stdout, file=self._out)
+
+
+# setup.py install rewrites the shared easy-install.pth, so concurrent
+# installs lose each other's entries
+_INSTALL_LOCK = threading.Lock()
+
+
+def _test_package(m, out):
+    try:
+        with _INSTALL_LOCK:
+            m.install(with_requirements=False)
+        m.test()
+        m.distribute()
+    finally:
+        # a single write per package keeps the output of packages
+        # built in parallel apart
+        sys.stdout.write("=" * 80 + "\n" + out.getvalue())
 
 
 @click.command()
-@cleanup
 def test():
-    c = delegator.run("git branch | grep \* | cut -d ' ' -f2")
-    if c.err:
-        raise RuntimeError("current branch is not shown due to err")
+    all_paths = set(find_pac_files())
 
-    all_paths = set(Path(".").rglob("pac.toml"))
+    changed_paths = track_changed_paths(
+        {path.parent.as_posix() for path in all_paths}
+    )
+    # nothing can be affected, don't bother reading any pac.toml
+    if not changed_paths:
+        print("No python changes found in packages")
+        return
 
-    changed_paths = track_changed_paths()
     pending_paths = all_paths - changed_paths
 
-    changed_packages = [
-        Pac.create(path, modified=True).package for path in changed_paths
-    ]
-    pending_packages = [Pac.create(path).package for path in pending_paths]
-    affected_packages = set()
+    # reading pac.toml files is mostly io, so overlap it. pending packages
+    # are only matched against the changed ones, the affected ones are
+    # fully created afterwards
+    cache = LightCache(PAC_CACHE_FILE)
+    with GitBatch() as b, ThreadPoolExecutor() as executor:
+        changed_pacs = executor.map(
+            functools.partial(Pac.create, modified=True, batch=b), changed_paths
+        )
+        pending_packages = list(
+            executor.map(Pac.create_light, pending_paths, repeat(cache))
+        )
+        changed_packages = [pac.package for pac in changed_pacs]
+    cache.save()
 
     package_names = {package.name: package for package in changed_packages}
 
+    # pending packages depending on each package name, with the dependency
+    reverse_index = defaultdict(list)
     for package in pending_packages:
-        # make sure we skip the package we have changed
-        if package in changed_packages:
-            continue
-
         for dependency in package.requires:
-            dependency_name = dependency.name
-            if dependency_name not in package_names:
-                continue
-
-            if package in affected_packages:
-                continue
+            reverse_index[dependency.name].append((package, dependency))
 
+    affected_packages = set()
+    for name, changed_package in package_names.items():
+        for package, dependency in reverse_index.get(name, ()):
             # pac's dependency is affected by changed packages
-            if dependency.accepts(package_names[dependency_name]):
+            if dependency.accepts(changed_package):
                 affected_packages.add(package)
 
-    affected_packages = list(affected_packages)
+    # the dependants of affected packages get them rebuilt, so they are
+    # affected as well. affected packages keep their version, only the
+    # constraints on changed packages need checking
+    queue = deque(affected_packages)
+    while queue:
+        package = queue.popleft()
+        for dependant, _ in reverse_index.get(package.name, ()):
+            if dependant not in affected_packages:
+                affected_packages.add(dependant)
+                queue.append(dependant)
+
+    affected_packages = [
+        Pac.create(package.pac_file).package for package in affected_packages
+    ]
 
     print(f"we have tracked changed packages: {changed_packages}")
     print(f"we have found affected packages: {affected_packages}")
 
     # make the dependecy tree
     # to deduce what is the test order of package
-    graph = dict()
-    for package in changed_packages:
-        # init anyway to make sure we have this index
-        graph[package.name] = []
-        for dep in package.requires:
-            if dep.name in package_names:
-                graph[package.name].append(dep.name)
-
-    known = []
-    while True:
-        graph_copy = graph.copy()
-        for pack_name in graph_copy.keys():
-            if len(graph[pack_name]) == 0:
-                known.append(pack_name)
-                del graph[pack_name]
-                continue
-
-            for dep in graph[pack_name]:
-                if dep in known:
-                    graph[pack_name].remove(dep)
-
-        if len(graph) == 0:
-            break
-
-    order = [package_names[name] for name in known]
-
-    global_requirements = []
-
-    for package in order + affected_packages:
-        # we need to assume all the requirements in package
-        # is already built there, to let us to install from
-        print("=" * 80)
-        m = PackageManager(package, is_dev=True)
-        m.install()
-        m.test()
-        m.distribute()
-        global_requirements.extend(m.requirements)
+    package_names.update((package.name, package) for package in affected_packages)
+    in_degree = {}
+    dependants = defaultdict(set)
+    for package in package_names.values():
+        # a dependency may be listed once per constraint, count it once
+        deps = {dep.name for dep in package.requires if dep.name in package_names}
+        in_degree[package.name] = len(deps)
+        for dep_name in deps:
+            dependants[dep_name].add(package.name)
+
+    # packages of the same level don't depend on each other
+    levels = []
+    frontier = [name for name, degree in in_degree.items() if degree == 0]
+    while frontier:
+        levels.append([package_names[name] for name in frontier])
+        next_frontier = []
+        for pack_name in frontier:
+            for dependant in dependants[pack_name]:
+                in_degree[dependant] -= 1
+                if in_degree[dependant] == 0:
+                    next_frontier.append(dependant)
+        frontier = next_frontier
+
+    if sum(len(level) for level in levels) != len(in_degree):
+        raise RuntimeError("Tested packages have circular dependencies")
+
+    packages = [package for level in levels for package in level]
+    tested_names = {package.name for package in packages}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        managers, outs = {}, {}
+        for package in packages:
+            package_workdir = Path(workdir) / package.name
+            package_workdir.mkdir()
+            outs[package.name] = io.StringIO()
+            managers[package.name] = PackageManager(
+                package, package_workdir, is_dev=True, out=outs[package.name]
+            )
+
+        # compile the requirements of all packages together once, which also
+        # detects global conflicts between them. the packages under test are
+        # left out, they are installed in order from their own setup.py
+        global_requirements = [
+            dep
+            for m in managers.values()
+            for dep in m.requirements
+            if dep.name not in tested_names
+        ]
+        PackageManager.generate_requirements_text(global_requirements, Path(workdir))
+        PackageManager.install_requirements(Path(workdir), is_dev=True)
+
+        for level in levels:
+            # we need to assume all the requirements in package
+            # is already built there, to let us to install from
+            max_workers = min(len(level), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(
+                    executor.map(
+                        _test_package,
+                        [managers[p.name] for p in level],
+                        [outs[p.name] for p in level],
+                    )
+                )
 
-    # detect global conflicts by checking the requirements compiled together
-    # try to compile and see if there is a error
-    PackageManager.generate_requirements_text(global_requirements)
     print("test done")
 
 
 @click.command()
 def merge():
-    changed_paths = track_changed_paths()
-
-    changed_pacs = [Pac.create(path, modified=True) for path in changed_paths]
+    pac_dirs = {path.parent.as_posix() for path in find_pac_files()}
+    changed_paths = track_changed_paths(pac_dirs)
+    if not changed_paths:
+        return
+
+    with GitBatch() as b, ThreadPoolExecutor() as executor:
+        changed_pacs = list(
+            executor.map(
+                functools.partial(Pac.create, modified=True, batch=b),
+                changed_paths,
+            )
+        )
     for pac in changed_pacs:
-        pac.local_config["package"]["version"] = pac.package.next_version
-        with open(pac.file.path, "w") as f:
-            f.write(pac.local_config.as_string())
+        # edit a fresh document, parsed ones are shared through the cache
+        local_config = loads(pac.file.read_text())
+        local_config["package"]["version"] = pac.package.next_version
+        pac.file.write_text(local_config.as_string())
 
 
 def search_package(name):
-    all_paths = set(Path(".").rglob("pac.toml"))
-    found = None
+    # packages usually live in a directory of the same name, so look
+    # there first and stop parsing toml files once the package is found
+    all_paths = sorted(
+        find_pac_files(), key=lambda path: path.parent.name != name
+    )
     for path in all_paths:
-        local_config = TomlFile(path.as_posix()).read()
+        local_config = load_pac(path)
         if local_config["package"]["name"] == name:
-            found = Pac.create(path)
-    return found
+            return Pac.create(path)
+    return None
 
 
 @click.command()
@@ -451,7 +843,8 @@ def distribute(name, test):
             "Can't find the toml file for subpackage name in the this repo"
         )
 
-    PackageManager(found.package, is_dev=test).distribute()
+    with tempfile.TemporaryDirectory() as workdir:
+        PackageManager(found.package, Path(workdir), is_dev=test).distribute()
 
 
 @click.command()
@@ -470,7 +863,8 @@ def install(name):
             "Can't find the toml file for subpackage name in the this repo"
         )
 
-    PackageManager(found.package, is_dev=test).install()
+    with tempfile.TemporaryDirectory() as workdir:
+        PackageManager(found.package, Path(workdir), is_dev=test).install()
 
 
 @click.command()